@@ -0,0 +1,289 @@
+""" Event loop server for the sync API, so that idle and long polling
+clients don't each hold a thread.
+
+    python async_serve.py
+
+One thread runs an asyncore loop doing all the socket I/O. Responses
+are built by calling the Flask app (so /api/sync, /api/sync/node and
+/api/metrics behave exactly as with serve.py) on a pool of worker
+threads, and handed back to the loop.
+
+A client can long poll with /api/sync?updated_time=<t>&wait=<seconds>.
+If nothing changed after t, the connection is parked on the loop,
+costing no thread, until the next refresh of the tree publishes a new
+version or the wait runs out.
+"""
+import asynchat
+import asyncore
+import heapq
+import logging
+import os
+import socket
+import sys
+from itertools import count
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from threading import Lock
+from StringIO import StringIO
+from time import time as time_now
+from urlparse import parse_qs
+from exceptions import ValueError
+
+DEFAULT_WORKERS = 8
+DEFAULT_MAX_WAIT = 60
+DEFAULT_BACKLOG = 1024
+MAX_HEADER_BYTES = 64 * 1024
+LOOP_TIMEOUT = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+class _Trigger(asyncore.file_dispatcher):
+    """ Lets other threads run callables on the loop thread, waking it
+    up through a pipe. Once closed, calls are dropped.
+    """
+
+    def __init__(self, socket_map):
+        read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+        os.close(read_fd)   # file_dispatcher works on a dup of it
+        self._calls = Queue()
+        # so that the write fd isn't closed under a call_soon
+        self._write_lock = Lock()
+
+    def readable(self): return True
+    def writable(self): return False
+    def handle_connect(self): pass
+
+    def call_soon(self, function, *args):
+        with self._write_lock:
+            if self._write_fd is None: return
+            self._calls.put((function, args))
+            os.write(self._write_fd, 'x')
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        while True:
+            try:
+                function, args = self._calls.get_nowait()
+            except Empty:
+                return
+            function(*args)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        with self._write_lock:
+            if self._write_fd is not None:
+                os.close(self._write_fd)
+                self._write_fd = None
+
+
+class _Channel(asynchat.async_chat):
+    """ One client connection. Reads a GET request's head, and writes
+    back whatever response the server hands it.
+    """
+
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self._head = []
+        self._head_size = 0
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self._head_size += len(data)
+        if self._head_size > MAX_HEADER_BYTES:
+            self.respond('431 Request Header Fields Too Large', [], '')
+            return
+        self._head.append(data)
+
+    def found_terminator(self):
+        lines = ''.join(self._head).split('\r\n')
+        self._head = []
+        # nothing more is read from a request
+        self.set_terminator(None)
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+        except ValueError:
+            self.respond('400 Bad Request', [], '')
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        self.server.handle_request(self, method, target, headers)
+
+    def respond(self, status, headers, body):
+        if not self.connected: return   # the client went away meanwhile
+        head = ['HTTP/1.0 ' + status]
+        head.extend('%s: %s' % header for header in headers
+                    if header[0].lower() not in ('content-length', 'connection'))
+        head.append('Content-Length: %d' % len(body))
+        head.append('Connection: close')
+        self.push('\r\n'.join(head) + '\r\n\r\n' + body)
+        self.close_when_done()
+
+    def handle_close(self):
+        self.server.forget(self)
+        self.close()
+
+
+class AsyncServer(asyncore.dispatcher):
+    """ Serves a WSGI app built on tree (like Example().app) from an event
+    loop. serve_forever() runs the loop, shutdown() stops it from any
+    thread.
+    """
+
+    def __init__(self, app, tree, host='127.0.0.1', port=5000,
+                 workers=DEFAULT_WORKERS, max_wait=DEFAULT_MAX_WAIT):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(DEFAULT_BACKLOG)
+        self.host, self.port = self.socket.getsockname()
+
+        self.app = app
+        self.tree = tree
+        self.max_wait = max_wait
+        self.pool = ThreadPool(workers)
+        self.trigger = _Trigger(self.socket_map)
+        # channel -> (deadline, environ)
+        self.parked = {}
+        # (deadline, sequence, channel), entries of channels no longer
+        # parked are skipped when they come up
+        self._deadlines = []
+        self._sequence = count()
+        self._running = False
+        tree.add_refresh_listener(self._on_refresh)
+
+    def _on_refresh(self, tree, changed_nodes):
+        self.trigger.call_soon(self._wake_parked)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _Channel(self, pair[0])
+
+    def _environ(self, method, target, headers):
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': 'HTTP/1.0',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(''),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.iteritems():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    def _wait_for(self, environ):
+        """ Seconds to park a /api/sync long poll for, or None if it
+        should be answered right away
+        """
+        if environ['PATH_INFO'] != '/api/sync': return None
+        params = parse_qs(environ['QUERY_STRING'])
+        try:
+            wait = min(float(params['wait'][0]), self.max_wait)
+            client_time = float(params.get('updated_time', ['0'])[0])
+        except (KeyError, ValueError):
+            return None
+        # at the current version, only the root would come back
+        if wait <= 0 or client_time < self.tree.get_version_time(): return None
+        return wait
+
+    def handle_request(self, channel, method, target, headers):
+        if method != 'GET':
+            channel.respond('405 Method Not Allowed', [('Allow', 'GET')], '')
+            return
+        environ = self._environ(method, target, headers)
+        wait = self._wait_for(environ)
+        if wait is None:
+            self._dispatch(channel, environ)
+        else:
+            deadline = time_now() + wait
+            self.parked[channel] = (deadline, environ)
+            heapq.heappush(self._deadlines, (deadline, next(self._sequence), channel))
+
+    def _call_app(self, environ):
+        """ Runs on a worker thread
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = status, headers
+        try:
+            result = self.app(environ, start_response)
+            try:
+                body = ''.join(result)
+            finally:
+                if hasattr(result, 'close'): result.close()
+        except Exception:
+            logger.exception("Error handling %s %s?%s", environ['REQUEST_METHOD'],
+                             environ['PATH_INFO'], environ['QUERY_STRING'])
+            return '500 Internal Server Error', [], ''
+        return response['status'], response['headers'], body
+
+    def _dispatch(self, channel, environ):
+        self.pool.apply_async(self._call_app, (environ,), callback=lambda result:
+            self.trigger.call_soon(channel.respond, *result))
+
+    def _wake_parked(self):
+        parked, self.parked = self.parked, {}
+        self._deadlines = []
+        for channel, (_, environ) in parked.iteritems():
+            self._dispatch(channel, environ)
+
+    def _expire_parked(self):
+        now = time_now()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, _, channel = heapq.heappop(self._deadlines)
+            entry = self.parked.get(channel)
+            if entry is not None and entry[0] == deadline:
+                del self.parked[channel]
+                self._dispatch(channel, entry[1])
+
+    def forget(self, channel):
+        self.parked.pop(channel, None)
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            asyncore.loop(timeout=LOOP_TIMEOUT, use_poll=True,
+                          map=self.socket_map, count=1)
+            self._expire_parked()
+        self.tree.remove_refresh_listener(self._on_refresh)
+        self.pool.close()
+        self.pool.join()
+        for dispatcher in self.socket_map.values():
+            dispatcher.close()
+
+    def _stop(self):
+        self._running = False
+
+    def shutdown(self):
+        self.trigger.call_soon(self._stop)
+
+
+if __name__ == '__main__':
+    import metrics
+    from serve import Example
+    metrics.enable()
+    example = Example()
+    server = AsyncServer(example.app, example.tree)
+    print "Serving on http://%s:%d" % (server.host, server.port)
+    server.serve_forever()
@@ -1,18 +1,31 @@
+import logging
+import sys
+from contextlib import contextmanager
 from time import time as time_now
+from threading import Condition, RLock
 from exceptions import AttributeError, NotImplementedError, RuntimeError
+from timeit import default_timer as timer
 from utils import hash_md5
+import metrics
+from interning import Interner
+from scheduler import RefreshScheduler
 # import pdb
 
 DEFAULT_HASH_VALUE = '0'
 
+logger = logging.getLogger(__name__)
+
 
 class InformationNode(object):
 
-    def __init__(self, pk, **info_data):
+    def __init__(self, pk, _interner=None, **info_data):
         if not info_data:
             info_data = {}
         self._set_base_attribute('_base_attributes',
-            ['_data_holder', '_pk', '_info_hash',])
+            ['_data_holder', '_pk', '_info_hash', '_interner'])
+        self._set_base_attribute('_interner', _interner)
+        if _interner is not None:
+            info_data = _interner.holder(info_data)
         self._set_base_attribute('_data_holder', info_data)
         self._set_base_attribute('_pk', pk)
         self._set_base_attribute('_info_hash', None)
@@ -29,12 +42,19 @@ class InformationNode(object):
         """Updates information hash and if update
         of whole tree is required adds the pk to
         the update hash queue"""
-        new = hash_md5(str(self))
+        if metrics.enabled:
+            metrics.inc('sync_update_hash_total', node_type='InformationNode')
+        if self._interner is not None:
+            new = self._interner.hash(self._pk, self._data_holder)
+        else:
+            new = hash_md5(str(self))
         if new != self._info_hash:
             self._info_hash = new
 
     def __setattr__(self, name, value):
         """Sets attribute and updates _info_hash"""
+        if name == '_data_holder' and self._interner is not None:
+            value = self._interner.holder(value)
         if name in self._base_attributes:
             self._set_base_attribute(name, value)
         else:
@@ -59,8 +79,49 @@ class InformationNode(object):
         return str(self._pk) + str(self._data_holder)
 
 
+class UpdateHashQueue(set):
+    """ The set of pks whose hashes are yet to be propagated, shared by
+    all nodes of a tree. Holds the lock a refresh runs under. When
+    defer_hashing is set, writes to a node's data skip hashing
+    altogether and only queue the node for the next refresh.
+    """
+
+    def __init__(self, *args):
+        super(UpdateHashQueue, self).__init__(*args)
+        self.lock = RLock()
+        self.changed = Condition(self.lock)
+        self.defer_hashing = False
+        self.notify_after = None
+        self.mutations = 0
+        self.first_mutation_at = None
+        self.last_mutation_at = None
+
+    def mutated(self, pk):
+        """ Queues a deferred write. Call with the lock held.
+        """
+        now = time_now()
+        self.add(pk)
+        if not self.mutations:
+            self.first_mutation_at = now
+        self.mutations += 1
+        self.last_mutation_at = now
+        if self.notify_after is not None and self.mutations >= self.notify_after:
+            self.changed.notify()
+
+    def published(self):
+        self.clear()
+        self.mutations = 0
+        self.first_mutation_at = None
+
+
+def _defers_hashing(update_hash_queue):
+    # nodes can be given any set, only an UpdateHashQueue defers
+    return getattr(update_hash_queue, 'defer_hashing', False)
+
+
 class Node(object):
-    def __init__(self, pk, update_hash_queue, _depth=0, **info_data):
+    def __init__(self, pk, update_hash_queue, _depth=0, _interner=None,
+                 **info_data):
         self._set_base_attribute('_pk', pk)
         self._set_base_attribute('_parent', None)
         self._set_base_attribute('_update_hash_queue', update_hash_queue)
@@ -71,7 +132,7 @@ class Node(object):
         self._set_base_attribute('_hash', DEFAULT_HASH_VALUE)
         self._set_base_attribute('_depth', _depth)
         self._set_base_attribute('_info',
-            InformationNode(pk, **info_data))
+            InformationNode(pk, _interner=_interner, **info_data))
         self._set_base_attribute('_updated_at', time_now())
         self._set_base_attribute('_base_attributes',[
             '_pk', '_parent', '_update_hash_queue', '_depth'
@@ -97,6 +158,11 @@ class Node(object):
         """
         if name in self._base_attributes:
             self._set_base_attribute(name, value)
+        elif _defers_hashing(self._update_hash_queue):
+            with self._update_hash_queue.lock:
+                self._info._data_holder[name] = value
+                self._update_hash_queue.mutated(self._pk)
+            return
         else:
             setattr(self._info, name, value)
         if name in ['_hash', '_children_hash']: return # to prevent recursion
@@ -106,6 +172,13 @@ class Node(object):
         return getattr(self._info, name)
 
     def __delattr__(self, name):
+        if _defers_hashing(self._update_hash_queue):
+            with self._update_hash_queue.lock:
+                if name not in self._info._data_holder:
+                    raise AttributeError(name)
+                del self._info._data_holder[name]
+                self._update_hash_queue.mutated(self._pk)
+            return
         self._info.__delattr__(name)
         self._update_hash()
 
@@ -125,6 +198,8 @@ class Node(object):
         so as to inform that I have a new updated hash, and the
         corresponding parents should be updated too.
         """
+        if metrics.enabled:
+            metrics.inc('sync_update_hash_total', node_type='Node')
 
         old = self.get_hash()
         self._info._update_hash()
@@ -153,6 +228,10 @@ class Node(object):
             raise NotImplementedError("Child should be of type " + type(self))
         node._parent = self
         self._children.append(node)
+        if _defers_hashing(self._update_hash_queue):
+            # refresh will hash self when it climbs up from node
+            self._update_hash_queue.mutated(node._pk)
+            return
         node._update_hash()
         self._update_hash_queue.add(node._pk)
         self._update_hash()
@@ -179,20 +258,121 @@ class SyncTree(object):
         if not root_info_data:
             raise RuntimeError(
                 "Tree should be initialised with root node data")
-        self.update_hash_queue = set()
+        self.update_hash_queue = UpdateHashQueue()
         self.root = Node(0, self.update_hash_queue, _depth=0, **root_info_data)
         self.root._parent = self.root
         self._last_pk = 0
+        self._pk_step = 1
         self._pk_to_node_mapper = {0: self.root}
+        # pk -> pks of its ancestors 1, 2, 4, ... levels up, for
+        # is_ancestor. Nodes are never re-parented, so this only grows
+        # with add_node.
+        self._ancestor_jumps = {0: ()}
+        self.generation = 0
+        self._refresh_listeners = []
+        self.scheduler = None
+        self.interner = None
+
+    def add_refresh_listener(self, listener):
+        """ Registers listener(tree, changed_nodes), called after
+        every refresh that actually changed the tree. A listener that
+        raises doesn't keep the others from seeing the generation; the
+        error is logged, and raised by refresh_tree once all have run.
+        """
+        self._refresh_listeners.append(listener)
+
+    def remove_refresh_listener(self, listener):
+        with self.update_hash_queue.lock:
+            self._refresh_listeners.remove(listener)
+
+    def set_pk_partition(self, index, count):
+        """ Makes this tree hand out only the pks p with p % count == index,
+        so that count trees can share one pk space
+        """
+        if len(self._pk_to_node_mapper) > 1:
+            raise RuntimeError("pk partition should be set before adding nodes")
+        if not 0 <= index < count:
+            raise RuntimeError("Partition index should be in [0, count)")
+        self._last_pk = index
+        self._pk_step = count
+
+    def enable_interning(self, interner=None):
+        """ Makes nodes keep their data in layouts and values shared
+        through interner (a new interning.Interner by default). Info
+        hashes are then computed by the interner, so a tree has to be
+        interned from the start to keep them stable.
+        """
+        if len(self._pk_to_node_mapper) > 1:
+            raise RuntimeError("Interning should be enabled before adding nodes")
+        self.interner = Interner() if interner is None else interner
+        with self.update_hash_queue.lock:
+            info = self.root._info
+            info._set_base_attribute('_interner', self.interner)
+            info._set_base_attribute('_data_holder',
+                self.interner.holder(info._data_holder))
+            self.root._update_hash()
+        return self.interner
 
     def add_node(self, parent, **info_data):
-        self._last_pk += 1
-        node = Node(self._last_pk, self.update_hash_queue,
-                    _depth = parent._depth + 1, **info_data)
-        parent.add_child(node)
-        self._pk_to_node_mapper[self._last_pk] = node
+        with self.update_hash_queue.lock:
+            self._last_pk += self._pk_step
+            node = Node(self._last_pk, self.update_hash_queue,
+                        _depth = parent._depth + 1, _interner=self.interner,
+                        **info_data)
+            parent.add_child(node)
+            self._pk_to_node_mapper[self._last_pk] = node
+            self._index_ancestors(node, parent)
         return node
 
+    def _index_ancestors(self, node, parent):
+        jumps = [parent._pk]
+        while True:
+            up = self._ancestor_jumps[jumps[-1]]
+            if len(up) < len(jumps): break
+            jumps.append(up[len(jumps) - 1])
+        self._ancestor_jumps[node._pk] = tuple(jumps)
+
+    def _lift(self, node, depth):
+        """ The ancestor of node at depth, in O(log n) jumps
+        """
+        pk, levels, k = node._pk, node._depth - depth, 0
+        while levels:
+            if levels & 1:
+                pk = self._ancestor_jumps[pk][k]
+            levels >>= 1
+            k += 1
+        return pk
+
+    def is_ancestor(self, ancestor_pk, pk):
+        """ Whether ancestor_pk is above pk (a node is not its own ancestor)
+        """
+        ancestor, node = self.get_node(ancestor_pk), self.get_node(pk)
+        if ancestor._depth >= node._depth: return False
+        return self._lift(node, ancestor._depth) == ancestor_pk
+
+    def ancestors(self, pk):
+        """ The pks from the parent of pk up to the root. The answer is
+        the whole path, so this just climbs the parents.
+        """
+        node, answer = self.get_node(pk), []
+        while node._parent != node:
+            node = node._parent
+            answer.append(node._pk)
+        return answer
+
+    def get_parent_map(self, pks):
+        """ {pk: parent pk} for every node on the paths from pks up to
+        the root (which is left out). Paths are climbed parent by parent
+        until they join one already seen, so shared ancestors cost once.
+        """
+        answer = {}
+        for pk in pks:
+            node = self.get_node(pk)
+            while node._parent != node and node._pk not in answer:
+                answer[node._pk] = node._parent._pk
+                node = node._parent
+        return answer
+
     def remove_node(self, node):
         raise RuntimeError(
             "Delete node by setting a deleted=True to its info and all it's \
@@ -208,27 +388,95 @@ class SyncTree(object):
     def refresh_tree(self):
         """ Refreshes the Sync tree hashes
         """
-        final_recursive_parents = set(self.get_node(x) for x in self.update_hash_queue)
-
-        for x in self.update_hash_queue:
-            node = self.get_node(x)
-            while node != node._parent:
-                final_recursive_parents.add(node._parent)
-                node = node._parent
-
-        progress = {node: False for node in final_recursive_parents}
-
-        for node in sorted(list(final_recursive_parents),
-                key=lambda x: x._depth, reverse=True):
-            if progress[node]: continue
-            node._update_hash()
-            progress[node] = True
-
-        self.update_hash_queue.clear()
+        with self.update_hash_queue.lock:
+            measured = metrics.enabled
+            if measured:
+                metrics.set_gauge('sync_refresh_queue_size', len(self.update_hash_queue))
+                started = timer()
+            final_recursive_parents = set(self.get_node(x) for x in self.update_hash_queue)
+
+            for x in self.update_hash_queue:
+                node = self.get_node(x)
+                while node != node._parent:
+                    final_recursive_parents.add(node._parent)
+                    node = node._parent
+
+            progress = {node: False for node in final_recursive_parents}
+
+            for node in sorted(list(final_recursive_parents),
+                    key=lambda x: x._depth, reverse=True):
+                if progress[node]: continue
+                node._update_hash()
+                progress[node] = True
+
+            self.update_hash_queue.published()
+            if measured:
+                metrics.observe('sync_refresh_seconds', timer() - started)
+                metrics.inc('sync_refreshed_nodes_total', len(final_recursive_parents))
+            if not final_recursive_parents: return
+
+            self.generation += 1
+            error = None
+            for listener in list(self._refresh_listeners):
+                try:
+                    listener(self, final_recursive_parents)
+                except Exception:
+                    logger.exception("Refresh listener %r failed", listener)
+                    if error is None: error = sys.exc_info()
+            if error is not None:
+                raise error[0], error[1], error[2]
+
+    @contextmanager
+    def batch(self):
+        """ Writes made inside the block are not hashed one by one,
+        the tree is refreshed once at the end instead. Other writers
+        and refreshes wait for the block to finish.
+        """
+        queue = self.update_hash_queue
+        with queue.lock:
+            deferred = queue.defer_hashing
+            queue.defer_hashing = True
+            try:
+                yield self
+            finally:
+                queue.defer_hashing = deferred
+            self.refresh_tree()
+
+    def get_version_time(self):
+        """ The updated time of the root, which is what a client
+        that is completely in sync will send back as updated_time
+        """
+        return self.root.get_update_time()
 
     def get_nodes_after_time(self, client_time):
-        return self.root._get_nodes_updated_in_my_subtree(
+        nodes = self.root._get_nodes_updated_in_my_subtree(
             client_time, set())
+        if metrics.enabled:
+            # the root, and every child of a node that was let in
+            metrics.inc('sync_nodes_visited_total',
+                1 + sum(len(node._children) for node in nodes))
+        return nodes
+
+    def start_refresh_scheduler(self, interval_ms=None, max_mutations=None,
+                                idle_ms=None):
+        """ Refreshes the tree from a background thread instead of
+        having to call refresh_tree(). While it runs, writes to node
+        data are not hashed, they only queue the node. See
+        RefreshScheduler for the policies.
+        """
+        if self.scheduler is not None:
+            raise RuntimeError("Refresh scheduler is already running")
+        self.scheduler = RefreshScheduler(self, interval_ms=interval_ms,
+            max_mutations=max_mutations, idle_ms=idle_ms)
+        self.scheduler.start()
+        return self.scheduler
+
+    def stop_refresh_scheduler(self):
+        """ Stops the scheduler after publishing whatever is pending
+        """
+        if self.scheduler is None: return
+        self.scheduler.stop()
+        self.scheduler = None
 
     def pretty_print(self):
         self.root.pretty_print()
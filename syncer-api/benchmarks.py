@@ -0,0 +1,306 @@
+""" Benchmarks for the hot paths of the sync tree.
+
+    python benchmarks.py --size 2000 --save results.json
+    python benchmarks.py --baseline results.json --threshold 0.2
+    python benchmarks.py --intern --baseline results.json
+
+Every tree shape is built with SyncTree.add_node, and then attribute
+writes, refresh_tree, get_nodes_after_time and the /api/sync and
+/api/sync/node handlers (through Flask's test client) are timed on it.
+Every benchmark runs WARMUP_ROUNDS times unrecorded, then REPEATS
+times. Throughput comes from the median repeat, and latencies from the
+samples of all of them. With --baseline, exits with 1 if any
+throughput dropped, or median latency went up, by more than the
+threshold.
+"""
+import argparse
+import json
+import resource
+import sys
+from exceptions import RuntimeError
+from multiprocessing import Pool
+from random import Random
+from timeit import default_timer as timer
+from flask import Flask
+from base import SyncTree
+from diff_cache import DiffCache
+from serve import Handler, register_routes
+
+DEFAULT_SIZE = 2000
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_SEED = 42
+# get_nodes_after_time recurses, so deep trees have to stay under the
+# recursion limit
+MAX_DEPTH = 400
+FETCH_BATCH = 50
+WARMUP_ROUNDS = 1
+REPEATS = 5
+
+
+def _payload(random):
+    return {"name": "item %d" % random.randint(0, 10 ** 6),
+            "price": random.random() * 1000,
+            "currency": random.choice(["INR", "USD", "EUR"])}
+
+
+def _large_payload(random):
+    payload = _payload(random)
+    payload["description"] = "x" * 2048
+    payload["tags"] = ["tag%d" % random.randint(0, 100) for x in range(50)]
+    return payload
+
+
+def _parent_picker(shape, random):
+    """ Returns parent(nodes) deciding where the next node of the shape goes
+    """
+    if shape == 'wide':
+        return lambda nodes: nodes[0]
+    if shape == 'deep':
+        return lambda nodes: nodes[-1] if len(nodes) % MAX_DEPTH else nodes[0]
+    if shape == 'balanced':
+        # children of node i are 2i+1, 2i+2
+        return lambda nodes: nodes[(len(nodes) - 1) // 2]
+    if shape == 'skewed':
+        # most nodes go under a few hot parents
+        return lambda nodes: nodes[int(len(nodes) * random.random() ** 4)]
+    return lambda nodes: random.choice(nodes)
+
+
+TREE_SHAPES = {
+    'wide': _payload,
+    'deep': _payload,
+    'balanced': _payload,
+    'skewed': _payload,
+    'large_payload': _large_payload,
+}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered: return 0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_memory_kb():
+    """ Peak RSS of the process so far. It only grows, so a benchmark
+    shows the peak reached by the time it finished. run_suite runs
+    every shape in a process of its own, so that this is the shape's
+    peak and not the biggest tree's so far.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarize(repeats):
+    """ Summarizes the samples of every repeat of a benchmark. ops and
+    seconds are those of the median repeat.
+    """
+    samples = [x for repeat in repeats for x in repeat]
+    ops = len(repeats[0]) if repeats else 0
+    total = percentile([sum(repeat) for repeat in repeats], 0.5)
+    return {"ops": ops,
+            "repeats": len(repeats),
+            "seconds": total,
+            "throughput": ops / total if total else 0,
+            "p50": percentile(samples, 0.5),
+            "p90": percentile(samples, 0.9),
+            "p99": percentile(samples, 0.99),
+            "max": max(samples) if samples else 0,
+            "peak_memory_kb": peak_memory_kb()}
+
+
+def _timed(operation, arguments, setup=None):
+    """ Times operation(x) for every x of arguments. setup(x), if
+    given, runs first and isn't timed.
+    """
+    samples = []
+    for x in arguments:
+        if setup is not None: setup(x)
+        started = timer()
+        operation(x)
+        samples.append(timer() - started)
+    return samples
+
+
+def _repeated(operation, arguments, setup=None):
+    """ The samples of every recorded repeat of _timed
+    """
+    repeats = []
+    for x in xrange(WARMUP_ROUNDS + REPEATS):
+        samples = _timed(operation, arguments, setup)
+        if x >= WARMUP_ROUNDS: repeats.append(samples)
+    return repeats
+
+
+def build_tree(shape, size, random, intern=False):
+    """ Builds a tree of the shape, returning it with its nodes and the
+    add_node latencies
+    """
+    tree = SyncTree(name="benchmark")
+    if intern:
+        tree.enable_interning()
+    nodes = [tree.root]
+    parent, payload = _parent_picker(shape, random), TREE_SHAPES[shape]
+
+    def add(x):
+        nodes.append(tree.add_node(parent(nodes), **payload(random)))
+    samples = _timed(add, xrange(size - 1))
+    return tree, nodes, samples
+
+
+def bench_shape(shape, size, random, intern=False):
+    results = {}
+    repeats = []
+    # a tree per repeat, the last one is used for the rest
+    for x in xrange(WARMUP_ROUNDS + REPEATS):
+        tree, nodes, samples = build_tree(shape, size, random, intern)
+        if x >= WARMUP_ROUNDS: repeats.append(samples)
+    results["add_node"] = summarize(repeats)
+
+    def queue_all(x):
+        # rehashes every node, like the first refresh of a new tree
+        tree.update_hash_queue.update(tree._pk_to_node_mapper)
+    results["refresh_tree.full"] = summarize(_repeated(
+        lambda x: tree.refresh_tree(), xrange(10), queue_all))
+
+    writes = [random.choice(nodes) for x in xrange(size)]
+    results["attribute_write"] = summarize(_repeated(
+        lambda node: setattr(node, "price", random.random()), writes))
+    tree.refresh_tree()
+
+    def write_10(x):
+        for node in random.sample(nodes, min(10, len(nodes))):
+            node.price = random.random()
+    results["refresh_tree.10_writes"] = summarize(_repeated(
+        lambda x: tree.refresh_tree(), xrange(50), write_10))
+
+    version = tree.get_version_time()
+    results["get_nodes_after_time.all"] = summarize(_repeated(
+        tree.get_nodes_after_time, [0] * 10))
+    results["get_nodes_after_time.recent"] = summarize(_repeated(
+        tree.get_nodes_after_time, [version] * 100))
+
+    results.update(bench_api(tree, nodes, random))
+    return results
+
+
+def bench_api(tree, nodes, random):
+    app = Flask(__name__)
+    register_routes(app, Handler(tree, DiffCache(tree)))
+    client = app.test_client()
+    results = {}
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError("%s returned %d" % (url, response.status_code))
+
+    results["api.sync.full"] = summarize(_repeated(get, ['/api/sync'] * 10))
+
+    def write_and_refresh():
+        for node in random.sample(nodes, min(10, len(nodes))):
+            node.price = random.random()
+        tree.refresh_tree()
+    # a client at a version the diff cache knows about
+    write_and_refresh()
+    base = tree.get_version_time()
+    write_and_refresh()
+    results["api.sync.incremental"] = summarize(_repeated(
+        get, ['/api/sync?updated_time=%r' % base] * 100))
+
+    def node_urls(request_type):
+        urls = []
+        for x in xrange(20):
+            pks = random.sample(nodes, min(FETCH_BATCH, len(nodes)))
+            urls.append('/api/sync/node?type=%s&%s' % (request_type,
+                '&'.join('pk=%d' % node._pk for node in pks)))
+        return urls
+    for request_type in ('check', 'fetch', 'get_parents'):
+        results["api.node." + request_type] = summarize(_repeated(
+            get, node_urls(request_type)))
+    results["api.node.get_parents.map"] = summarize(_repeated(
+        get, [url + '&format=map' for url in node_urls('get_parents')]))
+    return results
+
+
+def _bench_shape_with_seed(shape, size, seed, intern):
+    # same trees whichever shapes are picked
+    return bench_shape(shape, size, Random(seed), intern)
+
+
+def run_suite(size=DEFAULT_SIZE, shapes=None, seed=DEFAULT_SEED, intern=False):
+    """ Returns {"<shape>.<benchmark>": summary}. With intern, the trees
+    keep their data through an interning.Interner.
+    """
+    results = {}
+    for shape in sorted(shapes or TREE_SHAPES):
+        pool = Pool(1)
+        try:
+            shape_results = pool.apply(_bench_shape_with_seed,
+                                       (shape, size, seed, intern))
+        finally:
+            pool.close()
+            pool.join()
+        for name, summary in shape_results.iteritems():
+            results[shape + "." + name] = summary
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ Returns the regressions against baseline, as a list of
+    (benchmark, metric, baseline value, value). A drop in throughput
+    or a rise in median latency of more than threshold is a regression.
+    Both are medians, as the tail of a few samples is mostly noise.
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        old, new = baseline[name], results[name]
+        if new["throughput"] < old["throughput"] * (1 - threshold):
+            regressions.append((name, "throughput", old["throughput"], new["throughput"]))
+        if new["p50"] > old["p50"] * (1 + threshold):
+            regressions.append((name, "p50", old["p50"], new["p50"]))
+    return regressions
+
+
+def format_results(results):
+    lines = ["%-45s %8s %12s %10s %10s %10s %10s" % (
+        "benchmark", "ops", "ops/s", "p50 ms", "p90 ms", "p99 ms", "peak MB")]
+    for name in sorted(results):
+        x = results[name]
+        lines.append("%-45s %8d %12.1f %10.3f %10.3f %10.3f %10.1f" % (
+            name, x["ops"], x["throughput"], x["p50"] * 1000, x["p90"] * 1000,
+            x["p99"] * 1000, x["peak_memory_kb"] / 1024.0))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the sync tree")
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help="number of nodes in every tree")
+    parser.add_argument('--shape', action='append', choices=sorted(TREE_SHAPES),
+                        help="only run these tree shapes")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--intern', action='store_true',
+                        help="intern the data of the nodes")
+    parser.add_argument('--save', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against results saved earlier")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.size, args.shape, args.seed, args.intern)
+    print format_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, metric, old, new in regressions:
+            print "REGRESSION %s %s: %.6g -> %.6g" % (name, metric, old, new)
+        if regressions: return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
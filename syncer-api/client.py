@@ -0,0 +1,164 @@
+""" Reference client for the sync API, following the algorithm in the
+README: diff the hashes from /api/sync, get the parents of new nodes,
+and fetch the data of new and changed nodes.
+"""
+import json
+import urllib
+import urllib2
+from exceptions import RuntimeError
+
+DEFAULT_BATCH_SIZE = 100
+INFO_HASH = 1
+
+
+class SyncError(RuntimeError):
+    pass
+
+
+def http_transport(base_url, timeout=30):
+    """ Transport for a server at base_url, like http://localhost:5000
+    """
+    def get(path, params):
+        url = base_url + path + '?' + urllib.urlencode(params, doseq=True)
+        return urllib2.urlopen(url, timeout=timeout).read()
+    return get
+
+
+def app_transport(app):
+    """ Transport that calls a Flask app in process, through its test client
+    """
+    def get(path, params):
+        # a client per call, test clients aren't meant to be shared by threads
+        response = app.test_client().get(path, query_string=params)
+        return response.data
+    return get
+
+
+def _batches(items, size):
+    items = list(items)
+    return [items[x:x + size] for x in xrange(0, len(items), size)]
+
+
+class SyncClient(object):
+    """ Keeps a replica of the server's tree: {pk: {"hash", "updated_time",
+    "parent", "data"}}.
+
+    transport(path, params) does a GET and returns the body. The pks to
+    look up are sent batch_size at a time. Given a pool (like a
+    multiprocessing.pool.ThreadPool) the batches are sent through it
+    concurrently, and get_parents is sent alongside the fetch. Clients
+    can share a pool, as long as they aren't run from that same pool.
+    """
+
+    def __init__(self, transport, batch_size=DEFAULT_BATCH_SIZE, pool=None):
+        self.transport = transport
+        self.batch_size = batch_size
+        self.pool = pool
+        self.nodes = {}
+        self.updated_time = 0
+
+        self.syncs = 0
+        self.requests = 0
+        self.bytes_received = 0
+
+    def _get(self, path, **params):
+        body = self.transport(path, params)
+        # += on ints is not atomic, but the counters are only for reporting
+        self.requests += 1
+        self.bytes_received += len(body)
+        response = json.loads(body)
+        if not response.get("success"):
+            raise SyncError(response.get("error_message", "Request failed"))
+        return response["data"]
+
+    def _node_request(self, request_type, pks, concurrent=True, **params):
+        """ One /api/sync/node request per batch of pks, merged into
+        {pk: result}
+        """
+        batches = _batches(sorted(pks), self.batch_size)
+        if not batches: return {}
+
+        def call(batch):
+            return self._get('/api/sync/node', type=request_type, pk=batch, **params)
+        if len(batches) == 1 or self.pool is None or not concurrent:
+            results = map(call, batches)
+        else:
+            results = self.pool.map(call, batches)
+        answer = {}
+        for result in results:
+            for pk, value in result.iteritems():
+                answer[int(pk)] = value
+        return answer
+
+    def _fetch(self, pks):
+        for pk, obj in self._node_request('fetch', pks).iteritems():
+            node = self.nodes.setdefault(pk, {"parent": None, "updated_time": 0})
+            node["hash"] = tuple(obj["hash"])
+            node["data"] = obj["data"]
+
+    def sync(self, wait=None):
+        """ Brings the replica up to date. Returns the pks whose data
+        was fetched.
+
+        With wait, a server that long polls (async_serve.py) holds the
+        request up to that many seconds until there is something new.
+        """
+        params = {"updated_time": repr(self.updated_time)}
+        if wait is not None:
+            params["wait"] = repr(wait)
+        changed = self._get('/api/sync', **params)
+        new, to_fetch = [], []
+        for pk in sorted(changed, key=int):
+            obj, pk = changed[pk], int(pk)
+            sync_hash = tuple(obj["hash"])
+            node = self.nodes.get(pk)
+            if node is None:
+                new.append(pk)
+                to_fetch.append(pk)
+                continue
+            if node["hash"][INFO_HASH] != sync_hash[INFO_HASH]:
+                to_fetch.append(pk)
+            node["hash"] = sync_hash
+            node["updated_time"] = obj["updated_time"]
+
+        if self.pool is not None and new:
+            # parents don't depend on the fetch, ask for them in the meanwhile
+            # (its batches go one by one, it already holds a thread of the pool)
+            parents = self.pool.apply_async(self._node_request,
+                ('get_parents', new, False), {"format": "map"})
+            self._fetch(to_fetch)
+            parents = parents.get()
+        else:
+            self._fetch(to_fetch)
+            parents = self._node_request('get_parents', new, format='map')
+
+        for pk in new:
+            node = self.nodes[pk]
+            node["updated_time"] = changed[str(pk)]["updated_time"]
+            # the root is the only node without a parent in the map
+            node["parent"] = parents.get(pk)
+        if "0" in changed:
+            self.updated_time = max(self.updated_time, changed["0"]["updated_time"])
+        self.syncs += 1
+        return to_fetch
+
+    def get_root_hash(self):
+        node = self.nodes.get(0)
+        return None if node is None else node["hash"]
+
+    def is_in_sync(self):
+        """ Whether the replica's root hash is the server's
+        """
+        return self.get_root_hash() == tuple(self._node_request('check', [0])[0])
+
+    def verify(self, repair=True):
+        """ Checks every hash of the replica against the server. Returns
+        the pks that didn't match, after fetching them again if repair
+        is set.
+        """
+        server = self._node_request('check', self.nodes.keys())
+        mismatched = sorted(pk for pk, sync_hash in server.iteritems()
+                            if tuple(sync_hash) != self.nodes[pk]["hash"])
+        if repair:
+            self._fetch(mismatched)
+        return mismatched
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from threading import Lock
+from exceptions import ValueError
+
+DEFAULT_MAX_GENERATIONS = 64
+DEFAULT_MAX_CACHED_PKS = 100000
+
+
+class DiffCache(object):
+    """ Caches the set of changed pks between recent tree generations
+    and the current one, so that a client coming back with the
+    version time of a known generation is served by a lookup instead
+    of a traversal of the tree.
+
+    Every refresh publishes a new generation, whose version time is
+    the updated time of the root. The cache keeps the delta of the
+    last few generations, and composes consecutive deltas lazily when
+    a base generation is asked for. The composed diffs are kept in an
+    LRU. The pks held by the history and the diffs together are bounded
+    by max_cached_pks: diffs are evicted first, then the oldest
+    generations (the latest one is always kept).
+    """
+
+    def __init__(self, tree, max_generations=DEFAULT_MAX_GENERATIONS,
+                 max_cached_pks=DEFAULT_MAX_CACHED_PKS):
+        if max_generations < 1 or max_cached_pks < 0:
+            raise ValueError("Cache bounds should be positive")
+        self.tree = tree
+        self.max_generations = max_generations
+        self.max_cached_pks = max_cached_pks
+
+        # generation -> (version_time, base_pks, delta_pks)
+        self._history = OrderedDict()
+        self._version_to_generation = {}
+        # base generation -> (generation composed upto, pks). LRU order.
+        self._diffs = OrderedDict()
+        self._cached_pks = 0
+        self._history_pks = 0
+        # the latest generation recorded, which can be behind
+        # tree.generation while a refresh is publishing
+        self._generation = None
+        # lookups come from the server's request threads
+        self._lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        tree.add_refresh_listener(self._on_refresh)
+
+    def _on_refresh(self, tree, changed_nodes):
+        """ Records the delta of the generation that was just published.
+        base_pks is what a client at exactly this version would still
+        get from a traversal (the root, and anything touched at the
+        same instant as the root).
+        """
+        version_time = tree.get_version_time()
+        base_pks = frozenset(node._pk for node in
+                             tree.get_nodes_after_time(version_time))
+        delta_pks = frozenset(node._pk for node in changed_nodes)
+
+        with self._lock:
+            self._generation = tree.generation
+            self._history[tree.generation] = (version_time, base_pks, delta_pks)
+            self._history_pks += len(base_pks) + len(delta_pks)
+            self._version_to_generation[version_time] = tree.generation
+
+            while len(self._history) > self.max_generations:
+                self._forget_oldest()
+            self._trim()
+
+    def _forget_oldest(self):
+        generation, (old_time, base_pks, delta_pks) = self._history.popitem(last=False)
+        self._history_pks -= len(base_pks) + len(delta_pks)
+        if self._version_to_generation.get(old_time) == generation:
+            del self._version_to_generation[old_time]
+        self._drop(generation)
+
+    def _over_budget(self):
+        return self._history_pks + self._cached_pks > self.max_cached_pks
+
+    def _trim(self):
+        while self._over_budget() and self._diffs:
+            _, (_, evicted) = self._diffs.popitem(last=False)
+            self._cached_pks -= len(evicted)
+        while self._over_budget() and len(self._history) > 1:
+            self._forget_oldest()
+
+    def _drop(self, generation):
+        entry = self._diffs.pop(generation, None)
+        if entry is not None:
+            self._cached_pks -= len(entry[1])
+
+    def _store(self, generation, upto, pks):
+        if len(pks) + self._history_pks > self.max_cached_pks: return
+        self._diffs[generation] = (upto, pks)
+        self._cached_pks += len(pks)
+        self._trim()
+
+    def get_changed_pks(self, client_time):
+        """ Returns the pks changed after the given version time, or
+        None if client_time is not the version time of a generation
+        that is still remembered, or a later generation is missing
+        (say this cache's listener failed on it).
+        """
+        with self._lock:
+            generation = self._version_to_generation.get(client_time)
+            if generation is None:
+                self.misses += 1
+                return None
+
+            entry = self._diffs.get(generation)
+            if entry is not None:
+                self._drop(generation)
+                upto, pks = entry
+            else:
+                upto, pks = generation, self._history[generation][1]
+
+            if upto != self._generation:
+                pks = set(pks)
+                for later in xrange(upto + 1, self._generation + 1):
+                    if later not in self._history:
+                        self.misses += 1
+                        return None
+                    pks.update(self._history[later][2])
+                pks = frozenset(pks)
+
+            self._store(generation, self._generation, pks)
+            self.hits += 1
+            return pks
+
+    def get_nodes_after_time(self, client_time):
+        """ Drop in replacement for SyncTree.get_nodes_after_time that
+        looks up the cache first and traverses the tree only on a miss
+        """
+        pks = self.get_changed_pks(client_time)
+        if pks is None:
+            return self.tree.get_nodes_after_time(client_time)
+        return set(self.tree.get_node(pk) for pk in pks)
+
+    def clear(self):
+        with self._lock:
+            self._diffs.clear()
+            self._cached_pks = 0
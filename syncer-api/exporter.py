@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+from exceptions import ValueError
+from Queue import Queue
+from threading import Thread
+from time import time as time_now
+
+MANIFEST_FILE = 'manifest.json'
+SNAPSHOT_PREFIX = 'snapshot-'
+SNAPSHOT_FILE = SNAPSHOT_PREFIX + '%s-%d.json'
+DELTA_DIR = 'deltas'
+DELTA_FILE = '%s-%%d.json'
+DEFAULT_SNAPSHOT_EVERY = 32
+DEFAULT_KEEP_DELTAS = 64
+
+logger = logging.getLogger(__name__)
+
+
+class StaticExporter(object):
+    """ Exports the tree after every refresh as static files, so that
+    clients can sync from a plain file server or a CDN.
+
+    directory/
+        manifest.json           run, latest generation, root hash, which
+                                snapshot and which deltas are available
+        snapshot-<run>-<g>.json every node of generation g
+        deltas/<run>-<g>.json   nodes changed by generation g
+
+    Generations restart with every exporter, so each one has its own run
+    id, in the manifest and in the names of its files. A client at
+    generation c of the manifest's run, with c >= oldest_generation,
+    applies deltas c+1 ... latest. A client of another run, older than
+    that, or new, loads the snapshot and applies the deltas after it.
+    The manifest is written last, so it never points at a file that
+    isn't there yet, and the snapshot before the latest is kept for
+    those still holding the previous manifest. Files of earlier runs are
+    removed once the first manifest of this one is written.
+
+    If exporting a generation fails, the next one starts over from a
+    snapshot, rather than leave a delta out of the chain.
+
+    The tree is exported as soon as the exporter is created. Refreshes
+    only copy what changed, under the tree's lock; a writer thread
+    turns that into files, in order. flush() waits for it to catch up.
+    """
+
+    def __init__(self, tree, directory, snapshot_every=DEFAULT_SNAPSHOT_EVERY,
+                 keep_deltas=DEFAULT_KEEP_DELTAS):
+        if snapshot_every < 1 or keep_deltas < snapshot_every:
+            raise ValueError(
+                "keep_deltas should cover at least snapshot_every generations")
+        self.tree = tree
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.keep_deltas = keep_deltas
+        self.run = '%d-%s' % (time_now(), os.urandom(4).encode('hex'))
+
+        self._restart = False
+        self._snapshot_generation = None
+        self._previous_snapshot = None
+        self._oldest_generation = None
+        self._exported_info_hashes = {}
+
+        delta_dir = os.path.join(directory, DELTA_DIR)
+        if not os.path.isdir(delta_dir):
+            os.makedirs(delta_dir)
+        self._earlier_runs = [name for name in os.listdir(directory)
+                              if name.startswith(SNAPSHOT_PREFIX)]
+        self._earlier_runs.extend(os.path.join(DELTA_DIR, name)
+                                  for name in os.listdir(delta_dir))
+
+        self._jobs = Queue()
+        self._writer = Thread(target=self._run_writer)
+        self._writer.daemon = True
+        self._writer.start()
+
+        with tree.update_hash_queue.lock:
+            # publish anything pending, so that the first export has
+            # the hashes clients will be served
+            tree.refresh_tree()
+            self._export(tree.generation, None)
+            tree.add_refresh_listener(self._on_refresh)
+
+    def _run_writer(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None: return
+                function, args = job
+                function(*args)
+            except Exception:
+                logger.exception("Static export failed")
+                # a file of the chain may be missing
+                self._restart = True
+            finally:
+                self._jobs.task_done()
+
+    def _submit(self, function, *args):
+        self._jobs.put((function, args))
+
+    def flush(self):
+        """ Waits until every refresh so far is written out
+        """
+        self._jobs.join()
+
+    def close(self):
+        """ Stops exporting, after writing out what is pending
+        """
+        self.tree.remove_refresh_listener(self._on_refresh)
+        self._jobs.put(None)
+        self._writer.join()
+
+    def _write(self, name, obj):
+        path = os.path.join(self.directory, name)
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(obj, f, separators=(',', ':'))
+        os.rename(temp, path)
+
+    def _remove(self, name):
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _serialize(self, node, with_data):
+        """ Same shape as the /api/sync and fetch responses. The data
+        is left out when the client already has it.
+        """
+        obj = {"parent": node._parent._pk,
+               "hash": node.get_sync_hash(),
+               "updated_time": node.get_update_time()}
+        if with_data:
+            obj["data"] = dict(node._info._data_holder)
+        return obj
+
+    def _snapshot(self, generation):
+        nodes = self.tree._pk_to_node_mapper.values()
+        self._exported_info_hashes = {
+            node._pk: node.get_info_hash() for node in nodes}
+        return {"generation": generation,
+                "version_time": self.tree.get_version_time(),
+                "nodes": {node._pk: self._serialize(node, True) for node in nodes}}
+
+    def _delta(self, generation, changed_nodes):
+        serialized = {}
+        for node in changed_nodes:
+            info_hash = node.get_info_hash()
+            with_data = self._exported_info_hashes.get(node._pk) != info_hash
+            self._exported_info_hashes[node._pk] = info_hash
+            serialized[node._pk] = self._serialize(node, with_data)
+        return {"generation": generation,
+                "version_time": self.tree.get_version_time(),
+                "nodes": serialized}
+
+    def _manifest(self, generation):
+        return {"generation": generation,
+                "version_time": self.tree.get_version_time(),
+                "hash": self.tree.root.get_sync_hash(),
+                "run": self.run,
+                "snapshot": self._snapshot_file(self._snapshot_generation),
+                "snapshot_generation": self._snapshot_generation,
+                "oldest_generation": self._oldest_generation,
+                "deltas": DELTA_DIR + '/' + DELTA_FILE % self.run}
+
+    def _snapshot_file(self, generation):
+        return SNAPSHOT_FILE % (self.run, generation)
+
+    def _delta_file(self, generation):
+        return os.path.join(DELTA_DIR, DELTA_FILE % self.run % generation)
+
+    def _export(self, generation, changed_nodes):
+        """ Copies what generation changed into the files to write, and
+        queues them. Runs under the tree's lock.
+        """
+        files, stale = [], []
+        if self._snapshot_generation is None:
+            # nothing exported yet, start the chain from this generation
+            files.append((self._snapshot_file(generation), self._snapshot(generation)))
+            self._snapshot_generation = self._oldest_generation = generation
+            stale, self._earlier_runs = self._earlier_runs, []
+        elif self._restart:
+            # a generation is missing from the chain, drop it and start
+            # a new one from this generation
+            self._restart = False
+            files.append((self._snapshot_file(generation), self._snapshot(generation)))
+            stale.extend(self._delta_file(x) for x in
+                         xrange(self._oldest_generation + 1, generation + 1))
+            stale.append(self._snapshot_file(self._snapshot_generation))
+            if self._previous_snapshot is not None:
+                stale.append(self._snapshot_file(self._previous_snapshot))
+            self._previous_snapshot = None
+            self._snapshot_generation = self._oldest_generation = generation
+        else:
+            files.append((self._delta_file(generation), self._delta(generation, changed_nodes)))
+            if generation - self._snapshot_generation >= self.snapshot_every:
+                files.append((self._snapshot_file(generation), self._snapshot(generation)))
+                if self._previous_snapshot is not None:
+                    stale.append(self._snapshot_file(self._previous_snapshot))
+                self._previous_snapshot = self._snapshot_generation
+                self._snapshot_generation = generation
+
+        while generation - self._oldest_generation > self.keep_deltas:
+            self._oldest_generation += 1
+            stale.append(self._delta_file(self._oldest_generation))
+
+        files.append((MANIFEST_FILE, self._manifest(generation)))
+        self._submit(self._write_files, files, stale)
+
+    def _write_files(self, files, stale):
+        for name, obj in files:
+            self._write(name, obj)
+        # only now is no one pointed at these
+        for name in stale:
+            self._remove(name)
+
+    def _on_refresh(self, tree, changed_nodes):
+        try:
+            self._export(tree.generation, changed_nodes)
+        except Exception:
+            logger.exception("Static export of generation %d failed", tree.generation)
+            self._restart = True
@@ -0,0 +1,207 @@
+from exceptions import ValueError
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class TableIngest(object):
+    """ Keeps a SyncTree in sync with a SQL table of
+    (id, parent_id, <fields>..., updated_at[, deleted]) by polling it
+    for rows changed since the last poll.
+
+    Rows are read in batches ordered by (updated_at, id), and every
+    batch is applied inside tree.batch(), so the tree is hashed and
+    refreshed once per batch rather than once per row.
+
+     - A row with an unknown id is added under the node of its
+     parent_id, or under the root if parent_id is NULL. If its parent
+     hasn't been seen yet, it waits for a later batch.
+     - A row with a known id has its fields set on its node.
+     - A row whose parent_id changed is moved: the old nodes of its
+     subtree are marked deleted and the subtree is added again under
+     the new parent, the same way clients already see deletes and
+     inserts.
+     - A row with a true deleted column gets deleted=True set on its
+     node and all of its subtree, as the tree doesn't remove nodes.
+     When the row comes back, so does its subtree, except for the rows
+     that are deleted themselves. Rows deleted from the table outright
+     can't be seen by polling.
+
+    Works with any DB-API connection whose paramstyle is qmark, like
+    sqlite3.
+    """
+
+    def __init__(self, tree, connection, table, fields=None,
+                 key_column='id', parent_column='parent_id',
+                 updated_column='updated_at', deleted_column=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        if batch_size < 1:
+            raise ValueError("batch_size should be positive")
+        self.tree = tree
+        self.connection = connection
+        self.table = table
+        self.fields = fields
+        self.key_column = key_column
+        self.parent_column = parent_column
+        self.updated_column = updated_column
+        self.deleted_column = deleted_column
+        self.batch_size = batch_size
+
+        self.key_to_pk = {}
+        self._pk_to_key = {}
+        self._parent_keys = {}
+        # keys whose own row is deleted
+        self._deleted_keys = set()
+        self._pending = {}
+        # (updated_at, id) of the last row read
+        self._watermark = None
+
+    def _query(self):
+        columns = '*'
+        if self.fields is not None:
+            columns = ', '.join(_quote(x) for x in
+                [self.key_column, self.parent_column, self.updated_column] +
+                ([self.deleted_column] if self.deleted_column else []) +
+                list(self.fields))
+        updated, key = _quote(self.updated_column), _quote(self.key_column)
+        query = 'SELECT ' + columns + ' FROM ' + _quote(self.table)
+        params = ()
+        if self._watermark is not None:
+            query += ' WHERE ' + updated + ' > ? OR (' + updated + ' = ? AND ' + key + ' > ?)'
+            params = (self._watermark[0], self._watermark[0], self._watermark[1])
+        query += ' ORDER BY ' + updated + ', ' + key + ' LIMIT ?'
+        return query, params + (self.batch_size,)
+
+    def _fetch_batch(self):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(*self._query())
+            names = [x[0] for x in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def _info_data(self, row):
+        if self.fields is not None:
+            return {x: row[x] for x in self.fields}
+        skip = (self.key_column, self.parent_column, self.updated_column,
+                self.deleted_column)
+        return {k: v for k, v in row.iteritems() if k not in skip}
+
+    def _parent_node(self, parent_key):
+        if parent_key is None: return self.tree.root
+        pk = self.key_to_pk.get(parent_key)
+        return None if pk is None else self.tree.get_node(pk)
+
+    def _is_deleted(self, row):
+        return bool(self.deleted_column and row[self.deleted_column])
+
+    def _mark_deleted(self, node):
+        node.deleted = True
+        for child in node._children:
+            self._mark_deleted(child)
+
+    def _restore(self, node):
+        """ Undoes _mark_deleted, down to the rows deleted themselves.
+        Nodes without a key are old copies left behind by moves.
+        """
+        if getattr(node, 'deleted', False):
+            node.deleted = False
+        for child in node._children:
+            key = self._pk_to_key.get(child._pk)
+            if key is not None and key not in self._deleted_keys:
+                self._restore(child)
+
+    def _readd_subtree(self, node, parent):
+        """ Adds a live copy of node's subtree under parent, and points
+        the keys at the copies
+        """
+        copy = self.tree.add_node(parent, **node._info._data_holder)
+        key = self._pk_to_key.pop(node._pk, None)
+        if key is not None:
+            self.key_to_pk[key] = copy._pk
+            self._pk_to_key[copy._pk] = key
+        # deleted rows move along, so that they come back in place
+        for child in node._children:
+            if child._pk in self._pk_to_key:
+                self._readd_subtree(child, copy)
+        return copy
+
+    def _apply(self, row):
+        """ Applies a row. Returns False if it has to wait for its parent.
+        """
+        key, parent_key = row[self.key_column], row[self.parent_column]
+        pk = self.key_to_pk.get(key)
+
+        if self._is_deleted(row):
+            self._deleted_keys.add(key)
+            if pk is not None:
+                self._mark_deleted(self.tree.get_node(pk))
+            return True
+        self._deleted_keys.discard(key)
+
+        parent = self._parent_node(parent_key)
+        if parent is None: return False
+
+        data = self._info_data(row)
+        if pk is None:
+            node = self.tree.add_node(parent, **data)
+            self.key_to_pk[key] = node._pk
+            self._pk_to_key[node._pk] = key
+        else:
+            node = self.tree.get_node(pk)
+            moved = self._parent_keys[key] != parent_key
+            # moving under its own subtree has to wait for that to move away
+            if moved and (parent is node or
+                          self.tree.is_ancestor(node._pk, parent._pk)): return False
+            for name, value in data.iteritems():
+                if getattr(node, name, None) != value:
+                    setattr(node, name, value)
+            if getattr(node, 'deleted', False):
+                self._restore(node)
+            if moved:
+                self._readd_subtree(node, parent)
+                self._mark_deleted(node)
+        self._parent_keys[key] = parent_key
+        return True
+
+    def poll(self):
+        """ Reads and applies one batch. Returns the number of rows read.
+        """
+        rows = self._fetch_batch()
+        if not rows and not self._pending: return 0
+        if rows:
+            last = rows[-1]
+            self._watermark = (last[self.updated_column], last[self.key_column])
+
+        with self.tree.batch():
+            # a newer version of a waiting row replaces it
+            for row in rows:
+                self._pending.pop(row[self.key_column], None)
+            waiting = self._pending.values() + rows
+            self._pending = {}
+            while waiting:
+                left = [row for row in waiting if not self._apply(row)]
+                if len(left) == len(waiting): break
+                waiting = left
+            for row in waiting:
+                self._pending[row[self.key_column]] = row
+        return len(rows)
+
+    def poll_all(self):
+        """ Polls until the table has no more changes. Returns the number
+        of rows read.
+        """
+        total = 0
+        while True:
+            count = self.poll()
+            total += count
+            if count < self.batch_size: return total
+
+    def get_pending(self):
+        """ Keys of rows still waiting for their parent to show up
+        """
+        return self._pending.keys()
@@ -0,0 +1,177 @@
+""" Shared layouts and interned values for the data of InformationNodes.
+
+Nodes of a tree mostly have the same fields, and repeat a lot of the
+same values (categories, currencies, flags). With an Interner, a node's
+_data_holder is a SharedKeyDict: a list of values, laid out by a Layout
+(the sorted tuple of keys) that every holder with those keys shares.
+Immutable values are deduplicated, and their digests are computed once,
+so the info hash of a node is an md5 over its keys and the digests of
+its values instead of over the whole of str(data). Other values (floats,
+lists, dicts) go into that md5 as their repr. The hashes depend only on
+the data, not on which values happen to be interned.
+
+    tree = SyncTree(name="root")
+    tree.enable_interning()
+"""
+from bisect import bisect_left
+from utils import hash_md5
+
+DEFAULT_MAX_VALUES = 100000
+# values that can't change under a holder. Floats are left out, as they
+# are mostly unique, and 0.0 == -0.0 would merge two different values.
+INTERNED_TYPES = (str, unicode, int, long, bool, type(None))
+
+
+def _digest(value):
+    # '#' tells a digest apart from a repr, which never starts with it
+    return '#' + hash_md5(repr(value))
+
+
+class Layout(object):
+    """ The sorted keys of a holder, and the index of each key's value
+    """
+    __slots__ = ('interner', 'keys', 'index', 'prefixes', '_added', '_removed')
+
+    def __init__(self, interner, keys):
+        self.interner = interner
+        self.keys = keys
+        self.index = {key: i for i, key in enumerate(keys)}
+        self.prefixes = tuple('%r:' % (key,) for key in keys)
+        self._added = {}
+        self._removed = {}
+
+    def with_key(self, key):
+        layout = self._added.get(key)
+        if layout is None:
+            keys = list(self.keys)
+            keys.insert(bisect_left(keys, key), key)
+            layout = self._added.setdefault(key, self.interner.layout(tuple(keys)))
+        return layout
+
+    def without_key(self, key):
+        layout = self._removed.get(key)
+        if layout is None:
+            keys = tuple(x for x in self.keys if x != key)
+            layout = self._removed.setdefault(key, self.interner.layout(keys))
+        return layout
+
+
+class SharedKeyDict(object):
+    """ Stands in for the dict of an InformationNode's data. Supports
+    what the tree and the handlers use of a dict, dict(holder) makes a
+    real one.
+    """
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, layout, values):
+        self._layout = layout
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._layout.index[key]]
+
+    def __setitem__(self, key, value):
+        value = self._layout.interner.value(value)
+        i = self._layout.index.get(key)
+        if i is not None:
+            self._values[i] = value
+            return
+        self._layout = self._layout.with_key(key)
+        self._values.insert(self._layout.index[key], value)
+
+    def __delitem__(self, key):
+        i = self._layout.index[key]
+        self._layout = self._layout.without_key(key)
+        del self._values[i]
+
+    def __contains__(self, key): return key in self._layout.index
+    def __iter__(self): return iter(self._layout.keys)
+    def __len__(self): return len(self._values)
+
+    def get(self, key, default=None):
+        i = self._layout.index.get(key)
+        return default if i is None else self._values[i]
+
+    def keys(self): return list(self._layout.keys)
+    def values(self): return list(self._values)
+    def items(self): return zip(self._layout.keys, self._values)
+    def iteritems(self): return iter(self.items())
+    def copy(self): return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, SharedKeyDict): other = other.copy()
+        if not isinstance(other, dict): return NotImplemented
+        return self.copy() == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self): return repr(self.copy())
+
+
+class Interner(object):
+    """ The layouts, interned values and value digests shared by the
+    nodes of a tree. At most max_values values are interned; values
+    seen after that are kept as they are, and their digests computed
+    every time. Either way a value adds the same to the info hash, so
+    hashes don't depend on what the interner has seen.
+    """
+
+    def __init__(self, max_values=DEFAULT_MAX_VALUES):
+        # setdefault keeps these consistent without a lock, a race only
+        # builds an object that is thrown away
+        self._layouts = {}
+        # (type, value) -> (value, digest). The type keeps 1, 1L and
+        # True apart.
+        self._values = {}
+        self.max_values = max_values
+        self.empty = self.layout(())
+
+    def layout(self, keys):
+        layout = self._layouts.get(keys)
+        if layout is None:
+            layout = self._layouts.setdefault(keys, Layout(self, keys))
+        return layout
+
+    def _entry(self, value):
+        if type(value) not in INTERNED_TYPES: return None
+        key = (type(value), value)
+        entry = self._values.get(key)
+        if entry is None and len(self._values) < self.max_values:
+            entry = self._values.setdefault(key, (value, _digest(value)))
+        return entry
+
+    def value(self, value):
+        """ The shared instance of an immutable value
+        """
+        entry = self._entry(value)
+        return value if entry is None else entry[0]
+
+    def digest(self, value):
+        """ What value adds to the info hash: the digest of a value of
+        INTERNED_TYPES (cached once interned), or the repr of any other
+        """
+        if type(value) not in INTERNED_TYPES: return repr(value)
+        entry = self._entry(value)
+        return _digest(value) if entry is None else entry[1]
+
+    def holder(self, data):
+        """ A SharedKeyDict with the items of data
+        """
+        layout = self.empty
+        for key in data:
+            layout = layout.with_key(key)
+        return SharedKeyDict(layout, [self.value(data[key]) for key in layout.keys])
+
+    def hash(self, pk, holder):
+        """ The info hash of a node with pk and the data in holder
+        """
+        digest = self.digest
+        return hash_md5(str(pk) + ''.join(prefix + digest(value) + ',' for prefix, value
+                                          in zip(holder._layout.prefixes, holder._values)))
+
+    def __len__(self):
+        return len(self._values)
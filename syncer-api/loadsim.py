@@ -0,0 +1,169 @@
+""" Drives many SyncClients against the sync API while the tree mutates.
+
+    python loadsim.py --clients 1000 --size 500 --duration 10
+    python loadsim.py --http --clients 200
+
+The tree is written to by a mutator thread and refreshed by the tree's
+refresh scheduler. For --duration seconds the clients sync round robin
+from a pool of --workers threads. Then the writes stop, and the clients
+keep syncing until every replica has the server's root hash, which is
+the convergence time. In process, requests go through Flask's test
+client; with --http, through a threaded server on localhost.
+"""
+import argparse
+import json
+from multiprocessing.pool import ThreadPool
+from random import Random
+from threading import Event, Thread
+from time import sleep
+from timeit import default_timer as timer
+from flask import Flask
+from werkzeug.serving import WSGIRequestHandler, make_server
+from benchmarks import build_tree
+from client import SyncClient, app_transport, http_transport
+from diff_cache import DiffCache
+from serve import Handler, register_routes
+
+DEFAULT_CLIENTS = 200
+DEFAULT_SIZE = 500
+DEFAULT_DURATION = 5
+DEFAULT_WORKERS = 8
+DEFAULT_WRITES_PER_SECOND = 200
+DEFAULT_REFRESH_MS = 100
+DEFAULT_SEED = 42
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def _serve_on_localhost(app):
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=_QuietRequestHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _mutate(tree, nodes, random, writes_per_second, stopped):
+    """ Writes to random nodes until stopped, adding a node every tenth write
+    """
+    writes = 0
+    while not stopped.is_set():
+        node = random.choice(nodes)
+        if writes % 10:
+            node.price = random.random()
+        else:
+            nodes.append(tree.add_node(node, name="new %d" % writes))
+        writes += 1
+        sleep(1.0 / writes_per_second)
+
+
+def simulate(clients=DEFAULT_CLIENTS, size=DEFAULT_SIZE, duration=DEFAULT_DURATION,
+             workers=DEFAULT_WORKERS, writes_per_second=DEFAULT_WRITES_PER_SECOND,
+             refresh_ms=DEFAULT_REFRESH_MS, http=False, shape='balanced',
+             seed=DEFAULT_SEED):
+    """ Runs the simulation and returns its report as a dict
+    """
+    random = Random(seed)
+    tree, nodes, _ = build_tree(shape, size, random)
+    app = Flask(__name__)
+    register_routes(app, Handler(tree, DiffCache(tree)))
+    tree.refresh_tree()
+
+    server = None
+    if http:
+        server = _serve_on_localhost(app)
+        transport = http_transport('http://127.0.0.1:%d' % server.server_port)
+    else:
+        transport = app_transport(app)
+
+    request_pool = ThreadPool(workers)
+    client_pool = ThreadPool(workers)
+    sync_clients = [SyncClient(transport, pool=request_pool) for x in xrange(clients)]
+    try:
+        started = timer()
+        client_pool.map(lambda client: client.sync(), sync_clients)
+        initial_seconds = timer() - started
+        initial_requests = sum(x.requests for x in sync_clients)
+        initial_syncs = sum(x.syncs for x in sync_clients)
+        initial_bytes = sum(x.bytes_received for x in sync_clients)
+
+        stopped = Event()
+        tree.start_refresh_scheduler(interval_ms=refresh_ms)
+        mutator = Thread(target=_mutate,
+                         args=(tree, nodes, random, writes_per_second, stopped))
+        mutator.start()
+
+        ending = timer() + duration
+
+        def keep_syncing(client):
+            while timer() < ending:
+                client.sync()
+        client_pool.map(keep_syncing, sync_clients, chunksize=1)
+        load_seconds = timer() - started - initial_seconds
+
+        stopped.set()
+        mutator.join()
+        tree.stop_refresh_scheduler()
+        converge_started = timer()
+
+        def converge(client):
+            while True:
+                client.sync()
+                if client.is_in_sync(): return timer() - converge_started
+        convergence = client_pool.map(converge, sync_clients, chunksize=1)
+        mismatched = sum(len(x.verify(repair=False)) for x in sync_clients[:10])
+    finally:
+        client_pool.close()
+        request_pool.close()
+        if tree.scheduler is not None:
+            tree.stop_refresh_scheduler()
+        if server is not None:
+            server.shutdown()
+
+    syncs = sum(x.syncs for x in sync_clients) - initial_syncs
+    requests = sum(x.requests for x in sync_clients) - initial_requests
+    received = sum(x.bytes_received for x in sync_clients) - initial_bytes
+    return {
+        "clients": clients,
+        "nodes": len(tree._pk_to_node_mapper),
+        "initial_sync_seconds": initial_seconds,
+        "initial_bytes_per_client": initial_bytes / float(clients),
+        "load_seconds": load_seconds,
+        "syncs": syncs,
+        "requests": requests,
+        "requests_per_second": requests / load_seconds,
+        "bytes_per_sync": received / float(max(1, syncs)),
+        "convergence_seconds_max": max(convergence),
+        "convergence_seconds_mean": sum(convergence) / len(convergence),
+        "mismatched_after_convergence": mismatched,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load tests the sync API")
+    parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS)
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE,
+                        help="number of nodes the tree starts with")
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION,
+                        help="seconds of syncing while the tree mutates")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--writes-per-second', type=float,
+                        default=DEFAULT_WRITES_PER_SECOND)
+    parser.add_argument('--refresh-ms', type=int, default=DEFAULT_REFRESH_MS)
+    parser.add_argument('--http', action='store_true',
+                        help="go through a server on localhost")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    args = parser.parse_args(argv)
+
+    report = simulate(args.clients, args.size, args.duration, args.workers,
+                      args.writes_per_second, args.refresh_ms, args.http,
+                      seed=args.seed)
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
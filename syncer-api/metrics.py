@@ -0,0 +1,105 @@
+""" Counters and timers for the hot paths, rendered in the Prometheus
+text format on /api/metrics.
+
+Collection is off until enable() is called. Every hook first checks
+metrics.enabled, so when disabled the cost is one attribute lookup.
+"""
+from threading import Lock
+
+enabled = False
+
+COUNTER, GAUGE, SUMMARY = 'counter', 'gauge', 'summary'
+
+DEFINITIONS = {
+    'sync_hashes_total': (COUNTER, "md5 hashes computed by utils.hash_md5"),
+    'sync_hashed_bytes_total': (COUNTER, "Bytes hashed by utils.hash_md5"),
+    'sync_update_hash_total': (COUNTER, "_update_hash calls, by node type"),
+    'sync_nodes_visited_total': (COUNTER,
+        "Nodes visited while looking for nodes updated after a time"),
+    'sync_refresh_seconds': (SUMMARY, "Duration of refresh_tree"),
+    'sync_refresh_queue_size': (GAUGE,
+        "Size of the update hash queue at the start of the last refresh"),
+    'sync_refreshed_nodes_total': (COUNTER, "Nodes rehashed by refresh_tree"),
+    'sync_response_seconds': (SUMMARY, "API response latency, by endpoint"),
+    'sync_response_bytes': (SUMMARY, "API response size, by endpoint"),
+}
+
+_lock = Lock()
+_values = {}
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _values.clear()
+
+
+def _key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def inc(name, value=1, **labels):
+    with _lock:
+        series = _values.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _values.setdefault(name, {})[_key(labels)] = value
+
+
+def observe(name, value, **labels):
+    with _lock:
+        series = _values.setdefault(name, {})
+        key = _key(labels)
+        count, total = series.get(key, (0, 0))
+        series[key] = (count + 1, total + value)
+
+
+def get(name, **labels):
+    """ The value of a series, or (count, sum) for a summary
+    """
+    with _lock:
+        return _values.get(name, {}).get(_key(labels))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, labels, value):
+    if labels:
+        name += '{' + ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels) + '}'
+    # str, as repr of a long would end in L
+    return '%s %s' % (name, repr(value) if isinstance(value, float) else str(value))
+
+
+def render():
+    """ All the collected metrics in the Prometheus text format
+    """
+    with _lock:
+        values = {name: dict(series) for name, series in _values.iteritems()}
+    lines = []
+    for name in sorted(values):
+        metric_type, description = DEFINITIONS[name]
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels in sorted(values[name]):
+            value = values[name][labels]
+            if metric_type == SUMMARY:
+                lines.append(_series(name + '_count', labels, value[0]))
+                lines.append(_series(name + '_sum', labels, value[1]))
+            else:
+                lines.append(_series(name, labels, value))
+    return '\n'.join(lines) + '\n'
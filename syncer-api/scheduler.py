@@ -0,0 +1,120 @@
+import logging
+from threading import Thread
+from time import time as time_now
+from exceptions import ValueError
+
+# after a refresh failed before publishing, wait this long before
+# trying again
+RETRY_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler(Thread):
+    """ Background thread that refreshes a SyncTree on a policy, so
+    that bursts of writes get coalesced into one refresh. Any of
+
+        interval_ms     refresh every interval_ms, if anything changed
+        max_mutations   refresh once max_mutations writes are pending
+        idle_ms         refresh once there are no writes for idle_ms
+
+    can be given, and a refresh happens as soon as one of them is due.
+    A refresh that raises is logged, and the thread carries on. If it
+    failed while hashing, the writes are still pending and are retried
+    after RETRY_SECONDS. A listener that raises doesn't hold anything
+    back: the generation is published, and the other listeners have
+    seen it. Create it through SyncTree.start_refresh_scheduler().
+    """
+
+    def __init__(self, tree, interval_ms=None, max_mutations=None, idle_ms=None):
+        if interval_ms is None and max_mutations is None and idle_ms is None:
+            raise ValueError("Give at least one refresh policy")
+        super(RefreshScheduler, self).__init__(name="sync-tree-refresh")
+        self.daemon = True
+        self.tree = tree
+        self.interval = None if interval_ms is None else interval_ms / 1000.0
+        self.max_mutations = max_mutations
+        self.idle = None if idle_ms is None else idle_ms / 1000.0
+
+        self._stopped = False
+        self.last_refresh_at = time_now()
+        self.last_refresh_duration = 0
+        self.refreshes = 0
+        self.failures = 0
+        self._retry_at = 0
+
+    def _is_due(self, now):
+        queue = self.tree.update_hash_queue
+        if not queue or now < self._retry_at: return False
+        # pks queued without a deferred write (like the root of a new
+        # tree) have no mutation time, they count from the last refresh
+        last_mutation_at = queue.last_mutation_at
+        if last_mutation_at is None:
+            last_mutation_at = self.last_refresh_at
+        return any((
+            self.interval is not None and now - self.last_refresh_at >= self.interval,
+            self.max_mutations is not None and queue.mutations >= self.max_mutations,
+            self.idle is not None and now - last_mutation_at >= self.idle,
+            ))
+
+    def _wait_timeout(self, now):
+        timeouts = [x for x in (self.interval, self.idle) if x is not None]
+        if self._retry_at > now:
+            timeouts.append(self._retry_at - now)
+        return min(timeouts) if timeouts else None
+
+    def _refresh(self):
+        started = time_now()
+        self.tree.refresh_tree()
+        self.last_refresh_at = time_now()
+        self.last_refresh_duration = self.last_refresh_at - started
+        self.refreshes += 1
+
+    def get_lag(self):
+        """ Seconds for which the oldest write not yet published has
+        been waiting. 0 when the tree is up to date.
+        """
+        first_mutation_at = self.tree.update_hash_queue.first_mutation_at
+        if first_mutation_at is None: return 0
+        return max(0, time_now() - first_mutation_at)
+
+    def get_pending_mutations(self):
+        return self.tree.update_hash_queue.mutations
+
+    def run(self):
+        queue = self.tree.update_hash_queue
+        while True:
+            with queue.changed:
+                now = time_now()
+                if not self._stopped and not self._is_due(now):
+                    queue.changed.wait(self._wait_timeout(now))
+                if self._stopped: break
+                due = self._is_due(time_now())
+            if not due: continue
+            try:
+                self._refresh()
+            except Exception:
+                logger.exception("Refreshing the tree failed")
+                self.failures += 1
+                self._retry_at = time_now() + RETRY_SECONDS
+
+    def start(self):
+        queue = self.tree.update_hash_queue
+        with queue.lock:
+            queue.defer_hashing = True
+            queue.notify_after = self.max_mutations
+        super(RefreshScheduler, self).start()
+
+    def stop(self):
+        """ Stops the thread, turns hashing on writes back on and
+        publishes whatever was pending.
+        """
+        queue = self.tree.update_hash_queue
+        with queue.changed:
+            self._stopped = True
+            queue.changed.notify()
+        self.join()
+        with queue.lock:
+            queue.defer_hashing = False
+            queue.notify_after = None
+            self._refresh()
@@ -1,11 +1,31 @@
-from flask import Flask, jsonify, request
+from timeit import default_timer as timer
+from flask import Flask, Response, g, jsonify, request
 from exceptions import RuntimeError, ValueError
 from base import SyncTree
+from diff_cache import DiffCache
+from exporter import StaticExporter
+import metrics
+
+
+DEFAULT_STARTING_TIME = 0
+NODE_REQUEST_TYPES = ('check', 'fetch', 'get_parents')
+# metric label of requests that matched no route, so that probing
+# random urls can't make up new series
+UNMATCHED_ENDPOINT = 'unmatched'
+
+
+def _get_client_time(request):
+    try:
+        return float(request.args.get(
+            'updated_time', DEFAULT_STARTING_TIME))
+    except ValueError:
+        return DEFAULT_STARTING_TIME
 
 
 class Handler(object):
-    def __init__(self, tree):
+    def __init__(self, tree, diff_cache=None):
         self.tree = tree
+        self.diff_cache = diff_cache
 
     def _get_nodes(self, request):
         try:
@@ -21,46 +41,147 @@ class Handler(object):
         nodes = self._get_nodes(request)
         if nodes is None:
             return jsonify(success=False, error_message="Could not find pk")
-        return jsonify(success=True, data={
-            node._pk: node.get_sync_hash() for node in nodes})
+        with self.tree.update_hash_queue.lock:
+            data = {node._pk: node.get_sync_hash() for node in nodes}
+        return jsonify(success=True, data=data)
 
     def fetch(self, request):
         nodes = self._get_nodes(request)
         if nodes is None:
             return jsonify(success=False, error_message="Could not find pk")
-        response = {"success": True,
-                    "data": {node._pk: {
-                        "hash": node.get_sync_hash(),
-                        "data": node._info._data_holder
+        # copies, so that writes while this is serialized can't get in
+        with self.tree.update_hash_queue.lock:
+            response = {"success": True,
+                        "data": {node._pk: {
+                            "hash": node.get_sync_hash(),
+                            "data": dict(node._info._data_holder)
+                            }
+                            for node in nodes}
                         }
-                        for node in nodes}
-                    }
 
         return jsonify(**response)
 
-    def _get_parent(self, node):
-        answer = []
-        while node._parent != node:
-            answer.append(node._parent._pk)
-            node = node._parent
-        return answer
-
     def get_parents(self, request):
+        """ {pk: [parent, grandparent, ..., root]}, or with format=map
+        {pk: parent} over the union of those paths, which sends shared
+        ancestors once
+        """
         nodes = self._get_nodes(request)
         if nodes is None:
             return jsonify(success=False, error_message="Could not find pk")
+        if request.args.get('format') == 'map':
+            return jsonify(success=True, data=self.tree.get_parent_map(
+                node._pk for node in nodes))
         return jsonify(success=True,
-                       data={node._pk: self._get_parent(node)
+                       data={node._pk: self.tree.ancestors(node._pk)
                              for node in nodes})
 
+    def sync(self, request):
+        """ The nodes and the times sent are read under the tree's lock,
+        so a refresh can't finish in between. Otherwise the client could
+        be sent a root updated_time newer than the nodes it was sent.
+        """
+        client_time = _get_client_time(request)
+        with self.tree.update_hash_queue.lock:
+            if self.diff_cache is not None:
+                nodes = self.diff_cache.get_nodes_after_time(client_time)
+            else:
+                nodes = self.tree.get_nodes_after_time(client_time)
+            data = {node._pk: {
+                        "hash": node.get_sync_hash(),
+                        "updated_time": node.get_update_time()}
+                    for node in nodes}
+        return jsonify(success=True, data=data)
+
+
+class ShardedHandler(Handler):
+    """ Handler for a ShardedSyncTree, whose nodes live in the shard
+    processes and come back as plain dicts
+    """
+
+    def _get_pks(self, request):
+        try:
+            return [int(x) for x in request.args.getlist('pk')]
+        except ValueError:
+            return None
+
+    def _respond(self, request, query):
+        pks = self._get_pks(request)
+        if pks is None:
+            return jsonify(success=False, error_message="Could not find pk")
+        try:
+            return jsonify(success=True, data=query(pks))
+        except RuntimeError:
+            return jsonify(success=False, error_message="Could not find pk")
+
+    def check(self, request):
+        return self._respond(request, self.tree.check)
+
+    def fetch(self, request):
+        return self._respond(request, self.tree.fetch)
+
+    def get_parents(self, request):
+        if request.args.get('format') == 'map':
+            return self._respond(request, self.tree.get_parent_map)
+        return self._respond(request, self.tree.get_parents)
+
+    def sync(self, request):
+        return jsonify(success=True, data=self.tree.get_nodes_after_time(
+            _get_client_time(request)))
+
+
+def register_routes(app, handler):
+    @app.before_request
+    def start_timer():
+        if metrics.enabled:
+            g.started = timer()
+
+    @app.after_request
+    def record_response(response):
+        if metrics.enabled and 'started' in g:
+            rule = request.url_rule
+            labels = {'endpoint': UNMATCHED_ENDPOINT if rule is None else rule.rule}
+            if labels['endpoint'] == '/api/sync/node':
+                request_type = request.args.get('type', 'check')
+                labels['type'] = request_type \
+                    if request_type in NODE_REQUEST_TYPES else 'unknown'
+            metrics.observe('sync_response_seconds', timer() - g.started, **labels)
+            metrics.observe('sync_response_bytes',
+                            response.calculate_content_length() or 0, **labels)
+        return response
+
+    @app.route('/api/metrics')
+    def metrics_point():
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.route('/api/sync/node')
+    def end_point():
+        request_type = request.args.get('type', 'check')
+        handle_request = {'check': handler.check,
+                          'fetch': handler.fetch,
+                          'get_parents': handler.get_parents}
+        if request_type not in handle_request:
+            return jsonify(success=False,
+                           error_message="Unknown API call type.")
+        return handle_request[request_type](request)
+
+    @app.route('/api/sync')
+    def refresh_point():
+        return handler.sync(request)
+
 
 class Example(object):
 
-    def __init__(self):
+    def __init__(self, export_dir=None):
         self.app = Flask(__name__)
         self.app.debug = True
         self.basic_example_tree_create()
-        self.handler = Handler(self.tree)
+        self.diff_cache = DiffCache(self.tree)
+        self.exporter = None
+        if export_dir is not None:
+            self.exporter = StaticExporter(self.tree, export_dir)
+        self.handler = Handler(self.tree, self.diff_cache)
         self.set_up()
 
     def basic_example_tree_create(self):
@@ -77,33 +198,10 @@ class Example(object):
         self.tree.refresh_tree()
 
     def set_up(self):
-        @self.app.route('/api/sync/node')
-        def end_point():
-            request_type = request.args.get('type', 'check')
-            handle_request = {'check': self.handler.check,
-                              'fetch': self.handler.fetch,
-                              'get_parents': self.handler.get_parents}
-            if request_type not in handle_request:
-                return jsonify(success=False,
-                               error_message="Unknown API call type.")
-            return handle_request[request_type](request)
-
-        @self.app.route('/api/sync')
-        def refresh_point():
-            DEFAULT_STARTING_TIME = 0
-            try:
-                client_time = float(request.args.get(
-                    'updated_time', DEFAULT_STARTING_TIME))
-            except ValueError:
-                client_time = DEFAULT_STARTING_TIME
-            nodes = self.tree.get_nodes_after_time(client_time)
-            return jsonify(success=True,
-                           data={node._pk: {
-                                  "hash": node.get_sync_hash(),
-                                  "updated_time": node.get_update_time()}
-                                 for node in nodes})
+        register_routes(self.app, self.handler)
 
 
 if __name__ == '__main__':
+    metrics.enable()
     example = Example()
     example.app.run()
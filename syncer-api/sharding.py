@@ -0,0 +1,258 @@
+from multiprocessing import Pipe, Process
+from threading import RLock
+from time import time as time_now
+from exceptions import RuntimeError
+from base import SyncTree, InformationNode, DEFAULT_HASH_VALUE
+from utils import hash_md5
+
+
+class _Shard(object):
+    """ The part of a sharded tree living in a worker process. Its root
+    stands in for the forest's root, and its pks are partitioned so
+    that they are unique across shards. Writes are never hashed on the
+    spot, only when the coordinator asks for a refresh.
+    """
+
+    def __init__(self, index, count, root_info_data):
+        self.tree = SyncTree(**root_info_data)
+        self.tree.set_pk_partition(index, count)
+        self.tree.update_hash_queue.defer_hashing = True
+
+    def add_node(self, parent_pk, info_data):
+        return self.tree.add_node(self.tree.get_node(parent_pk), **info_data)._pk
+
+    def update_nodes(self, updates):
+        for pk, info_data in updates.iteritems():
+            node = self.tree.get_node(pk)
+            for name, value in info_data.iteritems():
+                setattr(node, name, value)
+
+    def refresh(self):
+        generation = self.tree.generation
+        self.tree.refresh_tree()
+        return self.tree.generation != generation, self.tree.root.get_children_hash()
+
+    def nodes_after(self, client_time):
+        return [(node._pk, node.get_sync_hash(), node.get_update_time())
+                for node in self.tree.get_nodes_after_time(client_time)
+                if node is not self.tree.root]
+
+    def check(self, pks):
+        return {pk: self.tree.get_node(pk).get_sync_hash() for pk in pks}
+
+    def fetch(self, pks):
+        nodes = [self.tree.get_node(pk) for pk in pks]
+        return {node._pk: {"hash": node.get_sync_hash(),
+                           "data": node._info._data_holder}
+                for node in nodes}
+
+    def parents(self, pks):
+        return {pk: self.tree.ancestors(pk) for pk in pks}
+
+    def parent_map(self, pks):
+        return self.tree.get_parent_map(pks)
+
+    def count(self):
+        return len(self.tree._pk_to_node_mapper) - 1
+
+
+def _serve_shard(connection, index, count, root_info_data):
+    shard = _Shard(index, count, root_info_data)
+    while True:
+        command, args = connection.recv()
+        if command is None: break
+        try:
+            connection.send((True, getattr(shard, command)(*args)))
+        except Exception as e:
+            connection.send((False, str(e)))
+    connection.close()
+
+
+class ShardedSyncTree(object):
+    """ A tree whose top level subtrees (the children of the root) are
+    spread over number_of_shards worker processes, each holding a
+    SyncTree. The root itself lives with this coordinator, and its
+    children hash is the hash of the shard roots' children hashes.
+
+    Nodes live in other processes, so instead of Node objects this
+    deals in pks and plain dicts. Writes and refreshes of different
+    shards run in parallel; queries are fanned out to the shards that
+    hold the pks, and merged. A pipe carries one command at a time, so
+    calls from different threads take turns on _lock.
+    """
+
+    def __init__(self, number_of_shards, **root_info_data):
+        if not root_info_data:
+            raise RuntimeError(
+                "Tree should be initialised with root node data")
+        if number_of_shards < 1:
+            raise RuntimeError("Need at least one shard")
+        self.number_of_shards = number_of_shards
+        self._root_info = InformationNode(0, **root_info_data)
+        self._root_dirty = True
+        self._children_hash = DEFAULT_HASH_VALUE
+        self._hash = DEFAULT_HASH_VALUE
+        self._updated_at = time_now()
+        self._top_level_count = 0
+        self.generation = 0
+        self._lock = RLock()
+
+        self._connections = []
+        self._processes = []
+        for index in xrange(number_of_shards):
+            mine, theirs = Pipe()
+            process = Process(target=_serve_shard,
+                              args=(theirs, index, number_of_shards, root_info_data))
+            process.daemon = True
+            process.start()
+            self._connections.append(mine)
+            self._processes.append(process)
+        self.refresh_tree()
+
+    def _shard_of(self, pk):
+        return pk % self.number_of_shards
+
+    def _receive(self, shard):
+        ok, result = self._connections[shard].recv()
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def _call(self, shard, command, *args):
+        with self._lock:
+            self._connections[shard].send((command, args))
+            return self._receive(shard)
+
+    def _call_many(self, command, args_per_shard):
+        """ Sends command to every shard in args_per_shard before waiting
+        for any of them, so that they work in parallel
+        """
+        with self._lock:
+            for shard, args in args_per_shard.iteritems():
+                self._connections[shard].send((command, args))
+            results, error = {}, None
+            for shard in args_per_shard:
+                try:
+                    results[shard] = self._receive(shard)
+                except RuntimeError as e:
+                    error = e
+        if error is not None: raise error
+        return results
+
+    def _group_by_shard(self, pks):
+        groups = {}
+        for pk in pks:
+            if pk == 0: continue
+            groups.setdefault(self._shard_of(pk), []).append(pk)
+        return {shard: (group,) for shard, group in groups.iteritems()}
+
+    def _merge(self, command, pks, root_value):
+        answer = {}
+        for result in self._call_many(command, self._group_by_shard(pks)).values():
+            answer.update(result)
+        if 0 in pks:
+            answer[0] = root_value()
+        return answer
+
+    def add_node(self, parent_pk, **info_data):
+        """ Adds a node under parent_pk and returns its pk. Children of
+        the root are dealt to the shards in turn.
+        """
+        with self._lock:
+            if parent_pk == 0:
+                shard = self._top_level_count % self.number_of_shards
+                self._top_level_count += 1
+            else:
+                shard = self._shard_of(parent_pk)
+            return self._call(shard, 'add_node', parent_pk, info_data)
+
+    def update_node(self, pk, **info_data):
+        self.update_nodes({pk: info_data})
+
+    def update_nodes(self, updates):
+        """ Sets the data of many nodes at once, given as {pk: info_data}
+        """
+        groups = {}
+        for pk, info_data in updates.iteritems():
+            if pk == 0: continue
+            groups.setdefault(self._shard_of(pk), {})[pk] = info_data
+        with self._lock:
+            if 0 in updates:
+                for name, value in updates[0].iteritems():
+                    setattr(self._root_info, name, value)
+                self._root_dirty = True
+            self._call_many('update_nodes',
+                {shard: (group,) for shard, group in groups.iteritems()})
+
+    def refresh_tree(self):
+        """ Refreshes every shard in parallel, then the root from the
+        shard roots
+        """
+        with self._lock:
+            results = self._call_many('refresh',
+                {shard: () for shard in xrange(self.number_of_shards)})
+            changed = self._root_dirty or any(x[0] for x in results.values())
+            self._root_dirty = False
+            if not changed: return
+
+            children_hashes = [results[shard][1] for shard in xrange(self.number_of_shards)]
+            children_hashes = [x for x in children_hashes if x != DEFAULT_HASH_VALUE]
+            self._children_hash = hash_md5(''.join(children_hashes)) \
+                if children_hashes else DEFAULT_HASH_VALUE
+            self._hash = hash_md5(self._children_hash + self._root_info._info_hash)
+            # after every shard's refresh, so the root is the newest node
+            self._updated_at = time_now()
+            self.generation += 1
+
+    def get_sync_hash(self):
+        return (self._hash, self._root_info._info_hash, self._children_hash)
+
+    def get_version_time(self):
+        return self._updated_at
+
+    def get_nodes_after_time(self, client_time):
+        """ {pk: {"hash", "updated_time"}} of the nodes changed after
+        client_time, like the /api/sync response
+        """
+        with self._lock:
+            if self._updated_at < client_time: return {}
+            answer = {0: {"hash": self.get_sync_hash(),
+                          "updated_time": self._updated_at}}
+            results = self._call_many('nodes_after',
+                {shard: (client_time,) for shard in xrange(self.number_of_shards)})
+        for nodes in results.values():
+            for pk, sync_hash, updated_time in nodes:
+                answer[pk] = {"hash": sync_hash, "updated_time": updated_time}
+        return answer
+
+    def check(self, pks):
+        return self._merge('check', pks, self.get_sync_hash)
+
+    def fetch(self, pks):
+        return self._merge('fetch', pks, lambda: {
+            "hash": self.get_sync_hash(),
+            "data": self._root_info._data_holder})
+
+    def get_parents(self, pks):
+        return self._merge('parents', pks, lambda: [])
+
+    def get_parent_map(self, pks):
+        """ {pk: parent pk} for the paths from pks up to the root, like
+        SyncTree.get_parent_map
+        """
+        return self._merge('parent_map', [pk for pk in pks if pk != 0], None)
+
+    def get_number_of_nodes(self):
+        counts = self._call_many('count',
+            {shard: () for shard in xrange(self.number_of_shards)})
+        return sum(counts.values()) + 1
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.send((None, ()))
+            for process in self._processes:
+                process.join()
+            for connection in self._connections:
+                connection.close()
+            self._connections, self._processes = [], []
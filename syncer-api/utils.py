@@ -1,5 +1,6 @@
 from hashlib import md5
 from custom_exceptions import CouldNotHashException
+import metrics
 # from base import SyncTree
 
 
@@ -11,6 +12,9 @@ def hash_md5(obj):
         raise CouldNotHashException("Could not convert object to string")
     temp = md5()
     temp.update(obj)
+    if metrics.enabled:
+        metrics.inc('sync_hashes_total')
+        metrics.inc('sync_hashed_bytes_total', len(obj))
     return temp.hexdigest()
 
 